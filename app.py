@@ -1,12 +1,32 @@
 import os
+import re
+import threading
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import tinytuya
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serializes responses with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- CONFIGURATION ---
 DEVICE_ID = os.getenv("TUYA_DEVICE_ID", "eb03bbe4df01c1351aaxjz")
@@ -22,8 +42,17 @@ USE_LOCAL = os.getenv("USE_LOCAL", "false").lower() == "true"
 LOCAL_KEY = os.getenv("TUYA_LOCAL_KEY", "")
 DEVICE_IP = os.getenv("TUYA_DEVICE_IP", "")
 
+# Matches socket codes like 'switch', 'switch_1' or 'switch_usb1'
+SW_RE = re.compile(r'^switch(?:_(.+))?$')
+
 # Initialize Tuya Connection
-def get_device():
+_device = None
+_device_lock = threading.Lock()
+# The cloud client is safe to share between request threads, but the local
+# device object holds its socket state and must only run one exchange at a time.
+_local_io_lock = threading.Lock()
+
+def create_device():
     if USE_LOCAL:
         if not LOCAL_KEY or not DEVICE_IP:
             raise ValueError("Local control requires TUYA_LOCAL_KEY and TUYA_DEVICE_IP")
@@ -34,8 +63,97 @@ def get_device():
         if not API_KEY or not API_SECRET:
             raise ValueError("Cloud control requires TUYA_API_KEY and TUYA_API_SECRET")
         c = tinytuya.Cloud(apiRegion=API_REGION, apiKey=API_KEY, apiSecret=API_SECRET)
+        # tinytuya never retries the token, so don't keep a client whose login failed
+        if not c.token:
+            raise ValueError(c.error)
         return c
 
+def get_device():
+    """Returns the shared Tuya device, creating it on first use so the token/socket is reused."""
+    global _device
+    if _device is None:
+        with _device_lock:
+            if _device is None:
+                _device = create_device()
+    return _device
+
+# Bursty callers within the TTL share one upstream status response
+_status_cache = TTLCache(maxsize=8, ttl=5)
+_status_cache_lock = threading.Lock()
+# One upstream fetch per device at a time; concurrent misses wait for it
+_status_fetch_locks = {}
+# Bumped by invalidate_status() so fetches that started before a command are not cached
+_status_generation = 0
+
+def read_status(device_id):
+    dev = get_device()
+    if USE_LOCAL:
+        with _local_io_lock:
+            return dev.status()
+    return dev.getstatus(device_id)
+
+def fetch_status(device_id):
+    with _status_cache_lock:
+        data = _status_cache.get(device_id)
+        if data is not None:
+            return data
+        fetch_lock = _status_fetch_locks.setdefault(device_id, threading.Lock())
+
+    with fetch_lock:
+        # Another request may have filled the cache while we waited
+        with _status_cache_lock:
+            data = _status_cache.get(device_id)
+            if data is not None:
+                return data
+            generation = _status_generation
+
+        data = read_status(device_id)
+
+        with _status_cache_lock:
+            if generation == _status_generation:
+                _status_cache[device_id] = data
+        return data
+
+def invalidate_status():
+    global _status_generation
+    with _status_cache_lock:
+        _status_generation += 1
+        _status_cache.clear()
+
+# Maps URL indices ('1', 'usb1', 'switch_1') to the device's switch codes.
+# Discovered from the Cloud status once; None until then (or in local mode).
+VALID_CODES = None
+
+def get_valid_codes():
+    global VALID_CODES
+    if VALID_CODES is None and not USE_LOCAL:
+        try:
+            data = fetch_status(DEVICE_ID)
+        except Exception:
+            # Leave validation to the device; discovery is retried on the next request
+            return None
+        # Only keep a table from a successful response that lists switches;
+        # otherwise stay undiscovered so the next request tries again
+        if isinstance(data, dict) and data.get('success') and isinstance(data.get('result'), list):
+            codes = {}
+            for item in data['result']:
+                m = SW_RE.match(str(item.get('code', '')))
+                if m:
+                    codes[item['code']] = item['code']
+                    if m.group(1):
+                        codes[m.group(1)] = item['code']
+            if codes:
+                VALID_CODES = codes
+    return VALID_CODES
+
+def resolve_code(index):
+    """Returns the switch code for a URL index, or None if the device has no such switch."""
+    codes = get_valid_codes()
+    if codes is None:
+        # Codes unknown, so fall back to the naming convention and let the device decide
+        return f"switch_{index}" if index.isdigit() else index
+    return codes.get(index)
+
 @app.route('/')
 def index():
     return jsonify({
@@ -46,6 +164,7 @@ def index():
             {"url": "/off", "method": "GET/POST", "desc": "Turn Master Switch OFF"},
             {"url": "/switch/<index>/on", "method": "GET/POST", "desc": "Turn specific switch ON (e.g. 1, 2, usb1)"},
             {"url": "/switch/<index>/off", "method": "GET/POST", "desc": "Turn specific switch OFF"},
+            {"url": "/switch/batch", "method": "POST", "desc": "Send several switch changes at once (JSON array of {code, value})"},
             {"url": "/status", "method": "GET", "desc": "Get Device Status"}
         ]
     })
@@ -53,11 +172,7 @@ def index():
 @app.route('/status', methods=['GET'])
 def get_status():
     try:
-        dev = get_device()
-        if USE_LOCAL:
-            data = dev.status()
-        else:
-            data = dev.getstatus(DEVICE_ID)
+        data = fetch_status(DEVICE_ID)
         return jsonify(data)
     except Exception as e:
         return jsonify({"error": str(e), "hint": "Check your .env configuration"}), 500
@@ -65,20 +180,18 @@ def get_status():
 @app.route('/sockets', methods=['GET'])
 def get_sockets():
     try:
-        dev = get_device()
+        data = fetch_status(DEVICE_ID)
         if USE_LOCAL:
-            data = dev.status()
             # Local status is usually a dict of DPS values like {'1': True, '2': False}
             # We need to map them if possible, or just return the raw DPS
             return jsonify({"type": "local", "dps": data})
         else:
-            data = dev.getstatus(DEVICE_ID)
             # Cloud data usually has a 'result' list with 'code' and 'value'
             if 'result' in data:
                 sockets = [
                     {"code": item['code'], "value": item['value']}
                     for item in data['result'] 
-                    if str(item['code']).startswith('switch')
+                    if SW_RE.match(str(item['code']))
                 ]
                 return jsonify({"sockets": sockets})
             return jsonify(data)
@@ -96,15 +209,38 @@ def turn_off_master():
 @app.route('/switch/<index>/on', methods=['POST', 'GET'])
 def turn_on_index(index):
     # Handle numeric indices or names like 'usb1'
-    code = f"switch_{index}" if index.isdigit() else index
+    code = resolve_code(index)
+    if code is None:
+        return jsonify({"error": f"Unknown switch '{index}'"}), 400
     return control_switch(code, True)
 
 @app.route('/switch/<index>/off', methods=['POST', 'GET'])
 def turn_off_index(index):
-    code = f"switch_{index}" if index.isdigit() else index
+    code = resolve_code(index)
+    if code is None:
+        return jsonify({"error": f"Unknown switch '{index}'"}), 400
     return control_switch(code, False)
 
+@app.route('/switch/batch', methods=['POST'])
+def control_batch():
+    # Body: [{"code": "switch_1", "value": true}, {"code": "switch_2", "value": false}]
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items or not all(
+        isinstance(item, dict) and 'code' in item and 'value' in item for item in items
+    ):
+        return jsonify({"error": "Expected a JSON array of {\"code\": ..., \"value\": ...} objects"}), 400
+    codes = get_valid_codes()
+    if codes is not None:
+        unknown = [item['code'] for item in items if item['code'] not in codes.values()]
+        if unknown:
+            return jsonify({"error": f"Unknown switch codes: {', '.join(map(str, unknown))}"}), 400
+    return send_commands([{"code": item['code'], "value": item['value']} for item in items])
+
 def control_switch(code, value):
+    return send_commands([{"code": code, "value": value}])
+
+def send_commands(items):
+    """Sends all switch changes to the device in a single command."""
     try:
         dev = get_device()
         if USE_LOCAL:
@@ -112,16 +248,20 @@ def control_switch(code, value):
             # but set_value works with DPS indices.
             # For simplicity in this generic script, we'll try standard methods or DPS.
             # Note: tinytuya's turn_on() defaults to the first switch.
-            if code == "switch_1":
-                if value: dev.turn_on()
-                else: dev.turn_off()
+            if len(items) == 1 and items[0]['code'] == "switch_1":
+                code, value = items[0]['code'], items[0]['value']
+                with _local_io_lock:
+                    if value: dev.turn_on()
+                    else: dev.turn_off()
+                invalidate_status()
             else:
                 # Map 'switch_N' to DPS index if possible, or use set_value if we know the DPS mapping
                 return jsonify({"error": "Local control for specific sockets requires DPS mapping. Use Cloud for easier code-based control."}), 501
         else:
-            # Cloud control uses standard instruction sets
-            commands = {"commands": [{"code": code, "value": value}]}
+            # Cloud control uses standard instruction sets; one request carries every command
+            commands = {"commands": items}
             res = dev.sendcommand(DEVICE_ID, commands)
+            invalidate_status()
             return jsonify(res)
             
         return jsonify({"message": f"Sent {value} to {code}", "status": "success"})
@@ -130,4 +270,10 @@ def control_switch(code, value):
 
 if __name__ == '__main__':
     print(f"Starting server for device: {DEVICE_ID}")
+    try:
+        # Warm up the shared connection and the switch code table before serving requests
+        get_device()
+        get_valid_codes()
+    except Exception as e:
+        print(f"Tuya device not initialized yet: {e}")
     app.run(host='0.0.0.0', port=5000, debug=True)
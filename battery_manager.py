@@ -1,21 +1,34 @@
 import os
+import sys
+import math
+import signal
+import logging
 import time
+import atexit
+import functools
 import psutil
-import subprocess
 import tinytuya
+from cachetools import TTLCache, cached
 from dotenv import load_dotenv
-from datetime import datetime
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from jeepney import DBusAddress, MatchRule, Properties, message_bus, new_method_call, unwrap_msg
+from jeepney.io.blocking import open_dbus_connection
+from service_utils import DBUS_TIMEOUT, next_deadline, notify_desktop, start_notifier
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions
 
 # Load environment variables
 load_dotenv()
 
+logging.basicConfig(format="[%(asctime)s] %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # --- CONFIGURATION ---
 ALLOWED_SSIDS = ["frans-extender", "frans-extender_5G", "Frans", "Frans-IOT"]
 BATTERY_MAX = 100
 BATTERY_MIN = 20
-CHECK_INTERVAL = 60  # Check every 60 seconds
+CHECK_INTERVAL = 60  # Poll interval when UPower signals are unavailable
+HEARTBEAT_INTERVAL = 300  # Safety-net check when no battery change has been signalled
+SSID_CACHE_TTL = 30  # Seconds to reuse the last SSID lookup
 
 # Tuya Config
 API_KEY = os.getenv("TUYA_API_KEY")
@@ -32,66 +45,119 @@ INFLUX_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUX_ORG = os.getenv("INFLUXDB_ORG")
 INFLUX_BUCKET = os.getenv("INFLUXDB_BUCKET")
 
+# UPower device type for batteries (see org.freedesktop.UPower.Device.Type)
+UPOWER_TYPE_BATTERY = 2
+
 # Switch 2 Code (usually "switch_2" or "2" for local)
 SWITCH_CODE = "switch_2" 
 SWITCH_INDEX = 2
 
-def get_influx_client():
-    if INFLUX_URL and INFLUX_TOKEN:
-        return InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
-    return None
+def init_influx():
+    """Creates one InfluxDB client with a batching write API for the process lifetime."""
+    if not (INFLUX_URL and INFLUX_TOKEN):
+        return None, None
+
+    client = InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG)
+    # Points are buffered client-side and POSTed in batches instead of one request per sample
+    write_api = client.write_api(write_options=WriteOptions(
+        batch_size=500, flush_interval=10_000, jitter_interval=2_000
+    ))
+
+    # Flush any buffered points before the process exits
+    def close():
+        write_api.close()
+        client.close()
+    atexit.register(close)
+
+    return client, write_api
+
+influx_client, influx_write_api = init_influx()
+
+def escape_measurement(value):
+    """Escapes a measurement name for line protocol (backslashes, commas, spaces)."""
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace(" ", "\\ ")
+
+def escape_key(value):
+    """Escapes a tag key, tag value or field key for line protocol (also escapes '=')."""
+    return escape_measurement(value).replace("=", "\\=")
+
+def format_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
 
 def write_to_influx(measurement, fields, tags=None):
     try:
-        client = get_influx_client()
-        if not client: return
-        
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-        point = Point(measurement)
-        
-        for k, v in fields.items():
-            point = point.field(k, v)
-            
+        if not influx_write_api: return
+
+        # InfluxDB rejects NaN and infinite floats, so leave those fields out
+        fields = {k: v for k, v in fields.items() if not (isinstance(v, float) and not math.isfinite(v))}
+        if not fields: return
+
+        # Build the line protocol record directly so the batcher only has to join strings
+        line = escape_measurement(measurement)
         if tags:
-            for k, v in tags.items():
-                point = point.tag(k, v)
-                
-        write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=point)
+            line += "".join(f",{escape_key(k)}={escape_key(v)}" for k, v in tags.items() if v)
+        line += " " + ",".join(f"{escape_key(k)}={format_field(v)}" for k, v in fields.items())
+        line += f" {time.time_ns()}"
+
+        influx_write_api.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=line, write_precision=WritePrecision.NS)
     except Exception as e:
-        print(f"InfluxDB Write Error: {e}")
+        logger.error("InfluxDB Write Error: %s", e)
+
+_system_bus = None
+
+def nm_property(path, interface, name):
+    """Reads a NetworkManager property over the system D-Bus."""
+    global _system_bus
+    if _system_bus is None:
+        _system_bus = open_dbus_connection(bus="SYSTEM")
+    addr = DBusAddress(path, bus_name="org.freedesktop.NetworkManager", interface=interface)
+    return unwrap_msg(_system_bus.send_and_get_reply(Properties(addr).get(name), timeout=DBUS_TIMEOUT))[0][1]
+
+@cached(TTLCache(maxsize=1, ttl=SSID_CACHE_TTL))
+def read_active_ssid():
+    for conn_path in nm_property("/org/freedesktop/NetworkManager", "org.freedesktop.NetworkManager", "ActiveConnections"):
+        conn_iface = "org.freedesktop.NetworkManager.Connection.Active"
+        if nm_property(conn_path, conn_iface, "Type") != "802-11-wireless":
+            continue
+        # For WiFi connections the specific object is the access point
+        ap_path = nm_property(conn_path, conn_iface, "SpecificObject")
+        ssid = nm_property(ap_path, "org.freedesktop.NetworkManager.AccessPoint", "Ssid")
+        return bytes(ssid).decode("utf-8", errors="replace")
+    return None
 
 def get_current_ssid():
-    """Returns the current WiFi SSID using iwgetid or nmcli."""
+    """Returns the current WiFi SSID from NetworkManager over D-Bus."""
+    global _system_bus
     try:
-        # Try iwgetid first (part of wireless-tools)
-        result = subprocess.run(["iwgetid", "-r"], capture_output=True, text=True)
-        if result.returncode == 0:
-            return result.stdout.strip()
-        
-        # Fallback to nmcli
-        result = subprocess.run(
-            ["nmcli", "-t", "-f", "active,ssid", "dev", "wifi"], 
-            capture_output=True, text=True
-        )
-        if result.returncode == 0:
-            for line in result.stdout.splitlines():
-                if line.startswith("yes:"):
-                    return line.split(":")[1]
+        return read_active_ssid()
     except Exception as e:
-        print(f"Error getting SSID: {e}")
+        logger.error("Error getting SSID: %s", e)
+        # Reconnect on the next lookup in case the bus connection dropped
+        if _system_bus is not None:
+            _system_bus.close()
+            _system_bus = None
     return None
 
-def send_notification(title, message, urgency="normal"):
+def deliver_notification(title, message, urgency="normal"):
     """Sends a GNOME notification."""
     try:
-        # Use 'tuya-app' to match the filename 'tuya-app.desktop'
-        subprocess.run(["notify-send", "-a", "tuya-app", "-u", urgency, title, message])
-        print(f"[{datetime.now()}] Notification sent: {title} - {message}")
+        notify_desktop(title, message, urgency)
+        logger.info("Notification sent: %s - %s", title, message)
     except Exception as e:
-        print(f"[{datetime.now()}] Failed to send notification: {e}")
+        logger.error("Failed to send notification: %s", e)
 
+# Notifications are delivered by a background worker so the loop never waits on them
+send_notification = start_notifier(deliver_notification)
+
+@functools.lru_cache(maxsize=1)
 def get_device():
-    """Initializes and returns the Tuya device object."""
+    """Initializes and returns the Tuya device object (cached so it is reused across cycles)."""
     if USE_LOCAL and DEVICE_IP and LOCAL_KEY:
         d = tinytuya.OutletDevice(DEVICE_ID, DEVICE_IP, LOCAL_KEY)
         d.set_version(3.3)
@@ -100,23 +166,37 @@ def get_device():
         c = tinytuya.Cloud(apiRegion=API_REGION, apiKey=API_KEY, apiSecret=API_SECRET)
         return c, "cloud"
 
+def set_switch_2(turn_on):
+    """Sends the Switch 2 command over the shared device connection."""
+    dev, mode = get_device()
+    if mode == "local":
+        # Local control
+        if turn_on:
+            res = dev.turn_on(switch=SWITCH_INDEX)
+        else:
+            res = dev.turn_off(switch=SWITCH_INDEX)
+    else:
+        # Cloud control
+        commands = {"commands": [{"code": SWITCH_CODE, "value": turn_on}]}
+        res = dev.sendcommand(DEVICE_ID, commands)
+
+    # tinytuya reports most failures in the response rather than raising
+    if isinstance(res, dict) and ('Error' in res or res.get('success') is False):
+        raise RuntimeError(res.get('Error') or res.get('msg') or res)
+
 def control_switch_2(turn_on):
     """Turns Switch 2 ON or OFF."""
-    dev, mode = get_device()
     action = "ON" if turn_on else "OFF"
-    print(f"[{datetime.now()}] Turning Switch 2 {action} via {mode}...")
     
     try:
-        if mode == "local":
-            # Local control
-            if turn_on:
-                dev.turn_on(switch=SWITCH_INDEX)
-            else:
-                dev.turn_off(switch=SWITCH_INDEX)
-        else:
-            # Cloud control
-            commands = {"commands": [{"code": SWITCH_CODE, "value": turn_on}]}
-            dev.sendcommand(DEVICE_ID, commands)
+        logger.info("Turning Switch 2 %s via %s...", action, get_device()[1])
+        try:
+            set_switch_2(turn_on)
+        except Exception as e:
+            # The cached socket/token may have gone stale; reconnect and retry once
+            logger.warning("Switch command failed (%s), reconnecting...", e)
+            get_device.cache_clear()
+            set_switch_2(turn_on)
             
         send_notification(
             f"Battery Manager: Charging {action}",
@@ -124,69 +204,165 @@ def control_switch_2(turn_on):
         )
         return True
     except Exception as e:
-        print(f"Error controlling device: {e}")
+        logger.error("Error controlling device: %s", e)
         send_notification("Battery Manager Error", f"Failed to control switch: {e}", "critical")
         return False
 
+def find_battery_path(conn):
+    """Returns the UPower object path of the laptop battery, or None if there is none."""
+    upower = DBusAddress(
+        "/org/freedesktop/UPower",
+        bus_name="org.freedesktop.UPower",
+        interface="org.freedesktop.UPower",
+    )
+    reply = conn.send_and_get_reply(new_method_call(upower, "EnumerateDevices"), timeout=DBUS_TIMEOUT)
+    for path in unwrap_msg(reply)[0]:
+        device = DBusAddress(path, bus_name="org.freedesktop.UPower", interface="org.freedesktop.UPower.Device")
+        props = Properties(device)
+        device_type = unwrap_msg(conn.send_and_get_reply(props.get("Type"), timeout=DBUS_TIMEOUT))[0][1]
+        power_supply = unwrap_msg(conn.send_and_get_reply(props.get("PowerSupply"), timeout=DBUS_TIMEOUT))[0][1]
+        if device_type == UPOWER_TYPE_BATTERY and power_supply:
+            return path
+    return None
+
+def subscribe_battery_changes():
+    """Subscribes to UPower PropertiesChanged signals for the battery.
+
+    Returns the connection and the deque the signals are collected in, or
+    (None, None) if UPower or a battery is not available so the caller can fall
+    back to polling.
+    """
+    conn = None
+    try:
+        conn = open_dbus_connection(bus="SYSTEM")
+        battery_path = find_battery_path(conn)
+        if battery_path is None:
+            raise RuntimeError("no battery device reported by UPower")
+        rule = MatchRule(
+            type="signal",
+            interface="org.freedesktop.DBus.Properties",
+            member="PropertiesChanged",
+            path=battery_path,
+        )
+        unwrap_msg(conn.send_and_get_reply(message_bus.AddMatch(rule), timeout=DBUS_TIMEOUT))
+        logger.info("Watching UPower battery %s", battery_path)
+        return conn, conn.filter(rule, bufsize=64).queue
+    except Exception as e:
+        logger.warning("UPower signals unavailable, polling every %ss: %s", CHECK_INTERVAL, e)
+        if conn is not None:
+            conn.close()
+        return None, None
+
+def wait_for_battery_change(conn, signals, deadline, interval):
+    """Blocks until UPower reports a new Percentage/State or the deadline passes.
+
+    Returns the deadline for the next wait. Scheduled checks are kept on a fixed
+    cadence from a monotonic clock, so time spent in a check does not push later
+    samples back; a signalled change leaves the schedule untouched. Errors on the
+    bus connection are raised so the caller can resubscribe.
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return next_deadline(deadline, interval)
+        if conn is None:
+            time.sleep(remaining)
+            continue
+        try:
+            msg = conn.recv_until_filtered(signals, timeout=remaining)
+        except TimeoutError:
+            continue
+
+        # Body is (interface, changed_properties, invalidated_properties)
+        changed = msg.body[1]
+        if "Percentage" in changed or "State" in changed:
+            return deadline
+
+def check_battery(last_action):
+    """Runs one battery check and returns the updated last action."""
+    # 1. Check WiFi
+    ssid = get_current_ssid()
+    if ssid not in ALLOWED_SSIDS:
+        logger.info("Connected to '%s' (Not allowed). Skipping check.", ssid)
+        return last_action
+
+    # 2. Check Battery
+    battery = psutil.sensors_battery()
+    if not battery:
+        logger.warning("Battery information not available.")
+        return last_action
+
+    percent = battery.percent
+    is_plugged = battery.power_plugged
+    
+    logger.info("SSID: %s | Battery: %s%% | Plugged: %s", ssid, percent, is_plugged)
+
+    # Log to InfluxDB
+    write_to_influx("battery_status", 
+        fields={"percent": float(percent), "plugged": bool(is_plugged)},
+        tags={"ssid": ssid, "device": "laptop"}
+    )
+
+    # 3. Logic
+    if percent >= BATTERY_MAX and is_plugged:
+        # Battery full, turn OFF charging
+        # We check if last_action is NOT OFF, meaning we haven't turned it off yet.
+        # OR if we just started (last_action is None), we should enforce the state.
+        # Force retry if plugged is still True
+        logger.info("Battery full. Cutting power...")
+        if control_switch_2(False):
+            last_action = "OFF"
+    
+    elif percent < BATTERY_MIN and not is_plugged:
+        # Battery low, turn ON charging
+        if last_action != "ON":
+            logger.info("Battery low. Starting power...")
+            if control_switch_2(True):
+                last_action = "ON"
+    
+    # Optional: If between 20 and 100, do nothing (hysteresis)
+    return last_action
+
 def main():
-    print(f"[{datetime.now()}] Starting Battery Manager Service...")
-    print(f"Allowed SSIDs: {ALLOWED_SSIDS}")
+    # systemd stops the service with SIGTERM, which skips atexit handlers (and so the
+    # InfluxDB flush) unless it is turned into a normal interpreter exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logger.info("Starting Battery Manager Service...")
+    logger.info("Allowed SSIDs: %s", ALLOWED_SSIDS)
+
+    # Connect once up front; the connection is kept for the life of the service
+    try:
+        get_device()
+    except Exception as e:
+        logger.error("Error initializing Tuya device: %s", e)
     
     # State tracking to avoid repeated commands
     # We don't know the initial state of the switch, so we might send a command once to sync.
     # But better to only act when thresholds are crossed.
     last_action = None # 'ON' or 'OFF'
 
+    # React to battery changes as UPower signals them instead of waking on a fixed interval
+    bus, battery_changes = subscribe_battery_changes()
+    interval = HEARTBEAT_INTERVAL if bus else CHECK_INTERVAL
+    deadline = time.monotonic() + interval
+
     while True:
         try:
-            # 1. Check WiFi
-            ssid = get_current_ssid()
-            if ssid not in ALLOWED_SSIDS:
-                print(f"[{datetime.now()}] Connected to '{ssid}' (Not allowed). Skipping check.")
-                time.sleep(CHECK_INTERVAL)
-                continue
-
-            # 2. Check Battery
-            battery = psutil.sensors_battery()
-            if not battery:
-                print("Battery information not available.")
-                time.sleep(CHECK_INTERVAL)
-                continue
-
-            percent = battery.percent
-            is_plugged = battery.power_plugged
-            
-            print(f"[{datetime.now()}] SSID: {ssid} | Battery: {percent}% | Plugged: {is_plugged}")
-
-            # Log to InfluxDB
-            write_to_influx("battery_status", 
-                fields={"percent": float(percent), "plugged": bool(is_plugged)},
-                tags={"ssid": ssid, "device": "laptop"}
-            )
-
-            # 3. Logic
-            if percent >= BATTERY_MAX and is_plugged:
-                # Battery full, turn OFF charging
-                # We check if last_action is NOT OFF, meaning we haven't turned it off yet.
-                # OR if we just started (last_action is None), we should enforce the state.
-                # Force retry if plugged is still True
-                print("Battery full. Cutting power...")
-                if control_switch_2(False):
-                    last_action = "OFF"
-            
-            elif percent < BATTERY_MIN and not is_plugged:
-                # Battery low, turn ON charging
-                if last_action != "ON":
-                    print("Battery low. Starting power...")
-                    if control_switch_2(True):
-                        last_action = "ON"
-            
-            # Optional: If between 20 and 100, do nothing (hysteresis)
-
+            last_action = check_battery(last_action)
         except Exception as e:
-            print(f"Error in main loop: {e}")
+            logger.error("Error in main loop: %s", e)
         
-        time.sleep(CHECK_INTERVAL)
+        try:
+            deadline = wait_for_battery_change(bus, battery_changes, deadline, interval)
+        except Exception as e:
+            # The bus connection is gone; back off to the polling interval and resubscribe
+            logger.error("Error waiting for UPower signal: %s", e)
+            bus.close()
+            time.sleep(CHECK_INTERVAL)
+            bus, battery_changes = subscribe_battery_changes()
+            interval = HEARTBEAT_INTERVAL if bus else CHECK_INTERVAL
+            deadline = time.monotonic() + interval
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,6 @@
 import os
 import tinytuya
-import json
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,12 +16,12 @@ print("--- Checking Device Status via Cloud ---")
 try:
     # getstatus returns the DPS values
     status = c.getstatus(DEVICE_ID)
-    print(f"getstatus: {json.dumps(status, indent=2)}")
+    print(f"getstatus: {orjson.dumps(status, option=orjson.OPT_INDENT_2).decode()}")
     
     # getconnectstatus
     print(f"Checking connection status for {DEVICE_ID}...")
     connect_status = c.getconnectstatus(DEVICE_ID)
-    print(f"getconnectstatus: {json.dumps(connect_status, indent=2)}")
+    print(f"getconnectstatus: {orjson.dumps(connect_status, option=orjson.OPT_INDENT_2).decode()}")
     
 except Exception as e:
     print(f"Error: {e}")
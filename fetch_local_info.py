@@ -1,6 +1,9 @@
 import tinytuya
 import os
 import json
+import select
+import socket
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,6 +13,35 @@ API_SECRET = os.getenv("TUYA_API_SECRET")
 API_REGION = os.getenv("TUYA_API_REGION", "us")
 DEVICE_ID = os.getenv("TUYA_DEVICE_ID")
 
+SCAN_TIMEOUT = 20  # Seconds to listen for the device broadcast
+
+def find_device_ip(device_id, timeout=SCAN_TIMEOUT):
+    """Listens for Tuya UDP broadcasts and returns the IP as soon as our device announces itself."""
+    socks = []
+    try:
+        # 6666 carries legacy plaintext broadcasts, 6667 the encrypted ones (v3.3+)
+        for port in (tinytuya.UDPPORT, tinytuya.UDPPORTS):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", port))
+            socks.append(sock)
+
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            readable, _, _ = select.select(socks, [], [], remaining)
+            for sock in readable:
+                data, addr = sock.recvfrom(4048)
+                try:
+                    info = json.loads(tinytuya.decrypt_udp(data))
+                except Exception:
+                    continue
+                if info.get('gwId') == device_id or info.get('id') == device_id:
+                    return info.get('ip') or addr[0]
+    finally:
+        for sock in socks:
+            sock.close()
+    return None
+
 print(f"--- Fetching Local Key for {DEVICE_ID} ---")
 
 try:
@@ -32,24 +64,16 @@ try:
     
     # 2. Scan local network for the IP address
     print("\n--- Scanning Local Network for Device IP ---")
-    print("This may take a few seconds...")
+    print(f"Waiting up to {SCAN_TIMEOUT} seconds for the device broadcast...")
     
-    # Scan for devices
-    found_devices = tinytuya.deviceScan(verbose=False)
-    
-    device_ip = None
-    
-    # Look for our device in the scan results
-    for ip, info in found_devices.items():
-        if info['gwId'] == DEVICE_ID or info['id'] == DEVICE_ID:
-            device_ip = ip
-            print(f"Found Device IP: {device_ip}")
-            break
+    # Stop listening as soon as our device is seen instead of running a full scan
+    device_ip = find_device_ip(DEVICE_ID)
             
     if not device_ip:
         print("Could not find device IP on local network. Make sure the device is plugged in and connected to WiFi.")
         print("If you unplugged it, please PLUG IT BACK IN so we can find its IP.")
     else:
+        print(f"Found Device IP: {device_ip}")
         print("\n--- SUCCESS ---")
         print(f"Please update your .env file with:")
         print(f"TUYA_LOCAL_KEY={local_key}")
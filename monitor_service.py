@@ -1,18 +1,27 @@
 import os
+import re
+import logging
 import time
 import tinytuya
-import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-from datetime import datetime
+from service_utils import next_deadline, notify_desktop, start_notifier
 
 # Load environment variables
 load_dotenv()
 
+logging.basicConfig(format="[%(asctime)s] %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 API_KEY = os.getenv("TUYA_API_KEY")
 API_SECRET = os.getenv("TUYA_API_SECRET")
 API_REGION = os.getenv("TUYA_API_REGION", "us")
 DEVICE_ID = os.getenv("TUYA_DEVICE_ID")
+USE_LOCAL = os.getenv("USE_LOCAL", "false").lower() == "true"
+LOCAL_KEY = os.getenv("TUYA_LOCAL_KEY")
+DEVICE_IP = os.getenv("TUYA_DEVICE_IP")
 DEVICE_NAME = "Socket Kamar Tidur"
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -20,6 +29,17 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
 # Configuration
 CHECK_INTERVAL = 10  # Seconds between checks
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats on the local socket
+
+# Matches socket codes like 'switch', 'switch_1' or 'switch_usb1'
+SW_RE = re.compile(r'^switch(?:_(.+))?$')
+
+# One session keeps the TLS connection to api.telegram.org warm between notifications
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=1,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
 
 def send_telegram_message(message):
     """Sends a message to Telegram."""
@@ -33,56 +53,149 @@ def send_telegram_message(message):
             "text": message,
             "parse_mode": "Markdown"
         }
-        requests.post(url, json=payload, timeout=5)
+        SESSION.post(url, json=payload, timeout=5)
     except Exception as e:
-        print(f"[{datetime.now()}] Failed to send Telegram message: {e}")
+        logger.error("Failed to send Telegram message: %s", e)
 
-def send_notification(title, message, urgency="normal"):
-    """Sends a GNOME notification using notify-send and Telegram."""
+def deliver_notification(title, message, urgency="normal"):
+    """Sends a GNOME notification over D-Bus and a Telegram message."""
     try:
-        # Use 'tuya-app' to match the filename 'tuya-app.desktop'
-        subprocess.run(["notify-send", "-a", "tuya-app", "-u", urgency, title, message])
-        print(f"[{datetime.now()}] Notification sent: {title} - {message}")
-        
-        # Send to Telegram as well
-        telegram_msg = f"*{title}*\n{message}"
-        if urgency == "critical":
-            telegram_msg = f"🚨 *{title}* 🚨\n{message}"
-        send_telegram_message(telegram_msg)
-        
+        notify_desktop(title, message, urgency)
+        logger.info("Notification sent: %s - %s", title, message)
     except Exception as e:
-        print(f"[{datetime.now()}] Failed to send notification: {e}")
+        logger.error("Failed to send notification: %s", e)
+        
+    # Send to Telegram as well
+    telegram_msg = f"*{title}*\n{message}"
+    if urgency == "critical":
+        telegram_msg = f"🚨 *{title}* 🚨\n{message}"
+    send_telegram_message(telegram_msg)
+
+# Notifications are delivered by a background worker so the loop never waits on them
+send_notification = start_notifier(deliver_notification)
+
+def get_device_info(c, device_id):
+    """Fetches the device's online flag and its DPS status list in one Cloud call.
+
+    /v1.0/devices/{id} returns both 'online' and 'status', so this replaces a
+    getconnectstatus followed by a getstatus. API failures are returned in the
+    same {'Error': ..., 'Payload': ...} shape tinytuya uses.
+    """
+    info = c.cloudrequest(f"/v1.0/devices/{device_id}")
+    if not info:
+        # tinytuya returns None when it cannot renew an expired token
+        return {"Error": "No response from Tuya Cloud", "Payload": ""}
+    if 'Error' in info:
+        return info
+    if not info.get('success'):
+        return {"Error": f"Cloud error {info.get('code')}", "Payload": str(info.get('msg', ''))}
+    return info.get('result', {})
 
-def get_socket_details(c, device_id):
+def get_socket_details(status_items):
     try:
-        status = c.getstatus(device_id)
-        if 'result' in status:
-            details = []
-            for item in status['result']:
-                code = item.get('code', '')
-                if code.startswith('switch'):
-                    # Extract number if possible, e.g. switch_1 -> S1
-                    label = code.replace('switch_', 'S').replace('switch', 'S')
-                    val = "ON" if item.get('value') else "OFF"
-                    details.append(f"{label}: {val}")
+        details = []
+        for item in status_items:
+            m = SW_RE.match(item.get('code', ''))
+            if m:
+                # Extract number if possible, e.g. switch_1 -> S1
+                label = 'S' + (m.group(1) or '')
+                val = "ON" if item.get('value') else "OFF"
+                details.append(f"{label}: {val}")
+        if details:
             return ", ".join(details)
     except Exception as e:
-        print(f"Error fetching details: {e}")
+        logger.error("Error fetching details: %s", e)
     return "Details unavailable"
 
+def get_local_details(dps):
+    # Local DPS are keyed by index, e.g. {'1': True, '2': False}; booleans are the sockets
+    details = [f"S{k}: {'ON' if v else 'OFF'}" for k, v in dps.items() if isinstance(v, bool)]
+    return ", ".join(details) if details else "Details unavailable"
+
+def watch_local():
+    """Watches the device over a persistent local socket.
+
+    Most Tuya firmware accepts only one local client at a time, so while this
+    runs the device's local connection is taken by the monitor. The device
+    pushes DPS changes as they happen, so state changes are picked up
+    immediately without polling the Cloud API. A heartbeat keeps the socket
+    alive and surfaces a dropped connection as an error response.
+    """
+    d = tinytuya.OutletDevice(DEVICE_ID, DEVICE_IP, LOCAL_KEY)
+    d.set_version(3.3)
+    d.set_socketPersistent(True)
+    d.set_socketRetryLimit(1)
+    d.set_socketTimeout(HEARTBEAT_INTERVAL)
+
+    last_is_online = None
+    dps = {}
+    data = d.status()
+
+    while True:
+        try:
+            if data is None:
+                # Nothing pushed within the timeout, ping the device to keep the socket
+                # alive; a dead connection comes back as an error response
+                data = d.heartbeat()
+
+            # None (no push, or an empty heartbeat ack) means the socket is still up;
+            # only an error response means the device is unreachable
+            is_online = not (isinstance(data, dict) and 'Error' in data)
+            if is_online and data and 'dps' in data:
+                dps.update(data['dps'])
+
+            if is_online != last_is_online:
+                if is_online:
+                    prefix = "Initial Status" if last_is_online is None else "Reconnected. Status"
+                    send_notification(
+                        f"{DEVICE_NAME} is Online",
+                        f"{prefix}: {get_local_details(dps)}",
+                        urgency="normal"
+                    )
+                    logger.info("Status: ONLINE")
+                else:
+                    logger.info("Status: OFFLINE - %s", data['Error'])
+                    if last_is_online is not None:
+                        send_notification(
+                            f"{DEVICE_NAME} is Offline",
+                            "The device is not connected to WiFi or is unavailable.",
+                            urgency="critical"
+                        )
+                last_is_online = is_online
+
+            if is_online:
+                data = d.receive()
+            else:
+                # Socket is down, wait before reconnecting
+                time.sleep(CHECK_INTERVAL)
+                data = d.status()
+
+        except Exception as e:
+            logger.error("Error reading local socket: %s", e)
+            # Treat as offline; the next pass waits and reconnects
+            data = {"Error": str(e)}
+
 def main():
-    print(f"[{datetime.now()}] Starting Monitor Service for {DEVICE_NAME} ({DEVICE_ID})...")
-    
+    logger.info("Starting Monitor Service for %s (%s)...", DEVICE_NAME, DEVICE_ID)
+
+    if USE_LOCAL and DEVICE_IP and LOCAL_KEY:
+        logger.info("Watching %s over a persistent local connection", DEVICE_IP)
+        watch_local()
+        return
+
+    # Cloud-only: poll the Cloud API for the connection status
     # Initialize Cloud connection
     try:
         c = tinytuya.Cloud(apiRegion=API_REGION, apiKey=API_KEY, apiSecret=API_SECRET)
     except Exception as e:
-        print(f"Error initializing Tuya Cloud: {e}")
+        logger.error("Error initializing Tuya Cloud: %s", e)
         return
 
     # Initial state
     last_is_online = None 
     last_api_error_notified = False
+    # Checks run on a fixed cadence from a monotonic clock so API latency does not cause drift
+    deadline = time.monotonic()
 
     while True:
         try:
@@ -106,13 +219,14 @@ def main():
             # To get REAL-TIME status, we MUST use Local.
             # Since the user couldn't find the IP, we will rely on Cloud for now.
             
-            is_online = c.getconnectstatus(DEVICE_ID)
+            # One call returns both the online flag and the socket states
+            device = get_device_info(c, DEVICE_ID)
             
             # Handle error response from tinytuya
-            if isinstance(is_online, dict) and 'Error' in is_online:
-                error_msg = is_online['Error']
-                payload = is_online.get('Payload', '')
-                print(f"[{datetime.now()}] Error checking status: {error_msg} - {payload}")
+            if 'Error' in device:
+                error_msg = device['Error']
+                payload = str(device.get('Payload', ''))
+                logger.error("Error checking status: %s - %s", error_msg, payload)
                 
                 if "don't have access to this API" in payload:
                     if not last_api_error_notified:
@@ -134,18 +248,17 @@ def main():
                 
                 is_online = False
             else:
+                is_online = bool(device.get('online'))
                 last_api_error_notified = False
 
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
             if last_is_online is None:
                 # First run, just set the state
                 last_is_online = is_online
                 status_str = "ONLINE" if is_online else "OFFLINE"
-                print(f"[{current_time}] Initial Status: {status_str}")
+                logger.info("Initial Status: %s", status_str)
                 
                 if is_online:
-                    details = get_socket_details(c, DEVICE_ID)
+                    details = get_socket_details(device.get('status', []))
                     send_notification(
                         f"{DEVICE_NAME} is Online", 
                         f"Initial Status: {details}",
@@ -156,13 +269,13 @@ def main():
                 # Status changed
                 if is_online:
                     # Changed from Offline -> Online
-                    details = get_socket_details(c, DEVICE_ID)
+                    details = get_socket_details(device.get('status', []))
                     send_notification(
                         f"{DEVICE_NAME} is Online", 
                         f"Reconnected. Status: {details}",
                         urgency="normal"
                     )
-                    print(f"[{current_time}] Status Changed: OFFLINE -> ONLINE")
+                    logger.info("Status Changed: OFFLINE -> ONLINE")
                 else:
                     # Changed from Online -> Offline
                     send_notification(
@@ -170,19 +283,20 @@ def main():
                         "The device is not connected to WiFi or is unavailable.",
                         urgency="critical"
                     )
-                    print(f"[{current_time}] Status Changed: ONLINE -> OFFLINE")
+                    logger.info("Status Changed: ONLINE -> OFFLINE")
                 
                 last_is_online = is_online
             else:
                 # No change, just log debug (optional, maybe too noisy)
-                # print(f"[{current_time}] Status stable: {'ONLINE' if is_online else 'OFFLINE'}")
+                # logger.debug("Status stable: %s", 'ONLINE' if is_online else 'OFFLINE')
                 pass
 
         except Exception as e:
-            print(f"[{datetime.now()}] Error checking status: {e}")
+            logger.error("Error checking status: %s", e)
             # We don't change last_is_online here to avoid flapping on network errors
         
-        time.sleep(CHECK_INTERVAL)
+        deadline = next_deadline(deadline, CHECK_INTERVAL)
+        time.sleep(max(0, deadline - time.monotonic()))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,70 @@
+import time
+import queue
+import threading
+from jeepney import DBusAddress, new_method_call, unwrap_msg
+from jeepney.io.blocking import open_dbus_connection
+
+# Helpers shared by battery_manager.py and monitor_service.py
+
+DBUS_TIMEOUT = 5  # Seconds to wait for a D-Bus reply
+
+# Desktop notifications go straight to the notification daemon over the session bus
+NOTIFICATIONS = DBusAddress(
+    "/org/freedesktop/Notifications",
+    bus_name="org.freedesktop.Notifications",
+    interface="org.freedesktop.Notifications",
+)
+URGENCY_LEVELS = {"low": 0, "normal": 1, "critical": 2}
+_session_bus = None
+
+def notify_desktop(title, message, urgency):
+    """Shows a GNOME notification via org.freedesktop.Notifications.Notify."""
+    global _session_bus
+    if _session_bus is None:
+        _session_bus = open_dbus_connection(bus="SESSION")
+    # Use 'tuya-app' to match the filename 'tuya-app.desktop'
+    hints = {
+        "urgency": ("y", URGENCY_LEVELS.get(urgency, 1)),
+        "desktop-entry": ("s", "tuya-app"),
+    }
+    msg = new_method_call(
+        NOTIFICATIONS, "Notify", "susssasa{sv}i",
+        ("tuya-app", 0, "", title, message, [], hints, -1),
+    )
+    try:
+        # A hung notification daemon raises TimeoutError instead of blocking the worker
+        unwrap_msg(_session_bus.send_and_get_reply(msg, timeout=DBUS_TIMEOUT))
+    except Exception:
+        # Reconnect next time in case the session bus connection dropped
+        _session_bus.close()
+        _session_bus = None
+        raise
+
+def start_notifier(deliver):
+    """Starts a background worker that calls deliver(title, message, urgency).
+
+    Returns a send_notification(title, message, urgency="normal") function that
+    queues the notification and returns immediately, so the caller's loop never
+    waits on delivery.
+    """
+    notify_q = queue.Queue()
+
+    def drain():
+        while True:
+            title, message, urgency = notify_q.get()
+            deliver(title, message, urgency)
+
+    threading.Thread(target=drain, name="notifications", daemon=True).start()
+
+    def send_notification(title, message, urgency="normal"):
+        notify_q.put_nowait((title, message, urgency))
+
+    return send_notification
+
+def next_deadline(deadline, interval):
+    """Advances a monotonic deadline by whole intervals, skipping any slots already missed."""
+    deadline += interval
+    now = time.monotonic()
+    if deadline <= now:
+        deadline += ((now - deadline) // interval + 1) * interval
+    return deadline
@@ -1,28 +1,36 @@
-import urllib.request
-import json
-import time
+import asyncio
+import aiohttp
+import orjson
 
 BASE_URL = "http://localhost:5000"
 
-def call_api(endpoint, method="GET"):
+async def call_api(session, endpoint, method="GET"):
     url = f"{BASE_URL}{endpoint}"
-    print(f"Testing: {endpoint} ...")
     try:
-        req = urllib.request.Request(url, method=method)
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            print(f"Response: {json.dumps(data, indent=2)}")
+        async with session.request(method, url) as response:
+            data = orjson.loads(await response.read())
+            return f"Testing: {endpoint} ...\nResponse: {orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()}"
     except Exception as e:
-        print(f"Failed: {e}")
+        return f"Testing: {endpoint} ...\nFailed: {e}"
 
-print("--- 1. Check Status ---")
-call_api("/status")
+async def main():
+    async with aiohttp.ClientSession() as session:
+        # Read-only endpoints are independent, so check them concurrently
+        print("--- 1. Check Status & Sockets ---")
+        for result in await asyncio.gather(
+            call_api(session, "/status"),
+            call_api(session, "/sockets"),
+        ):
+            print(result)
 
-print("\n--- 2. Turn ON (Master) ---")
-call_api("/on", method="POST")
+        # ON/OFF change device state and must run in order
+        print("\n--- 2. Turn ON (Master) ---")
+        print(await call_api(session, "/on", method="POST"))
 
-print("\nWaiting 5 seconds...")
-time.sleep(5)
+        print("\nWaiting 5 seconds...")
+        await asyncio.sleep(5)
 
-print("\n--- 3. Turn OFF (Master) ---")
-call_api("/off", method="POST")
+        print("\n--- 3. Turn OFF (Master) ---")
+        print(await call_api(session, "/off", method="POST"))
+
+asyncio.run(main())